@@ -0,0 +1,214 @@
+# admission.py
+# Kiểm soát nạp request cho các endpoint gọi LLM: giới hạn số request chạy đồng thời,
+# hàng đợi có giới hạn và ưu tiên, token bucket theo từng client.
+# Request bị từ chối sớm (429 + Retry-After) thay vì chờ đến khi client timeout.
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "4"))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+# Mỗi client: RATE request/giây, tối đa BURST request liên tiếp
+CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "0.5"))
+CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "5"))
+# Proxy tin cậy (IP, phân tách bằng dấu phẩy): chỉ request đi qua các proxy này mới được
+# dùng header X-Client-Id / X-Forwarded-For làm định danh client
+TRUSTED_PROXIES = {ip.strip() for ip in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",") if ip.strip()}
+
+# Độ ưu tiên trong hàng đợi (số nhỏ được phục vụ trước)
+PRIORITY_CACHED = 0
+PRIORITY_DEFAULT = 1
+
+# Số token bucket tối đa giữ trong bộ nhớ; bucket ít dùng nhất bị bỏ trước
+_MAX_BUCKETS = 10000
+
+
+def client_key(request) -> str:
+    """Định danh client cho token bucket: địa chỉ IP của kết nối.
+
+    Header do client tự gửi (X-Client-Id, X-Forwarded-For) chỉ được tin khi kết nối đến từ
+    một proxy trong ADMISSION_TRUSTED_PROXIES, nếu không client đổi id mỗi request là vượt được rate limit.
+    """
+    host = request.client.host if request.client else "unknown"
+    if host not in TRUSTED_PROXIES:
+        return host
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    # Phần tử cuối do chính proxy tin cậy thêm vào, các phần tử trước đó client có thể giả mạo
+    forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    return forwarded[-1] if forwarded else host
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Lấy một token; trả về 0 nếu được phép, ngược lại số giây cần chờ."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float(MAX_WAIT)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT,
+        max_queue: int = MAX_QUEUE,
+        max_wait: float = MAX_WAIT,
+        client_rate: float = CLIENT_RATE,
+        client_burst: float = CLIENT_BURST,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiters: list = []
+        # Waiter bị request ưu tiên hơn đẩy ra, chờ được đánh thức để trả về queue_full
+        self._evicted: set = set()
+        self._seq = itertools.count()
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # Thời gian xử lý trung bình (EWMA), dùng để ước lượng Retry-After
+        self._service_time = 2.0
+        self._counters = {
+            "admitted": 0,
+            "fast_path": 0,
+            "shed_rate_limited": 0,
+            "shed_queue_full": 0,
+            "shed_timeout": 0,
+        }
+
+    # -------------------- API chính --------------------
+    def acquire(self, client_id: str, priority: int = PRIORITY_DEFAULT) -> float:
+        """Xin một chỗ chạy LLM; raise AdmissionRejected nếu bị từ chối. Trả về thời điểm bắt đầu."""
+        with self._cond:
+            immediate = self._active < self.max_concurrent and not self._waiters
+            victim = None
+            # Xét chỗ trong hàng đợi trước, để request bị từ chối vì đầy không tốn token của client
+            if not immediate and len(self._waiters) >= self.max_queue:
+                victim = self._eviction_victim(priority)
+                if victim is None:
+                    self._counters["shed_queue_full"] += 1
+                    raise AdmissionRejected("queue_full", self._estimated_wait())
+            self._check_rate(client_id)
+            if immediate:
+                self._active += 1
+                self._counters["admitted"] += 1
+            else:
+                if victim is not None:
+                    self._evict(victim)
+                self._wait_in_queue(priority)
+        return time.monotonic()
+
+    def release(self, started: float) -> None:
+        with self._cond:
+            self._active -= 1
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, client_id: str, priority: int = PRIORITY_DEFAULT) -> Iterator[None]:
+        started = self.acquire(client_id, priority)
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def record_fast_path(self) -> None:
+        with self._cond:
+            self._counters["fast_path"] += 1
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self._active,
+                "queue_depth": len(self._waiters),
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "avg_service_seconds": round(self._service_time, 3),
+                **self._counters,
+            }
+
+    # -------------------- Nội bộ --------------------
+    def _check_rate(self, client_id: str) -> None:
+        # Gọi khi đang giữ self._cond
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            bucket = self._buckets[client_id] = TokenBucket(self.client_rate, self.client_burst)
+            # LRU có giới hạn cứng: bỏ bucket ít dùng nhất
+            while len(self._buckets) > _MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client_id)
+        wait = bucket.take()
+        if wait > 0:
+            self._counters["shed_rate_limited"] += 1
+            raise AdmissionRejected("rate_limited", wait)
+
+    def _eviction_victim(self, priority: int):
+        # Hàng đợi đầy: request mới chỉ được vào nếu ưu tiên hơn waiter kém nhất
+        # (ưu tiên thấp nhất, đến muộn nhất)
+        worst = max(self._waiters)
+        return worst if priority < worst[0] else None
+
+    def _evict(self, entry) -> None:
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+        self._evicted.add(entry)
+        self._counters["shed_queue_full"] += 1
+        self._cond.notify_all()
+
+    def _wait_in_queue(self, priority: int) -> None:
+        # Gọi khi đang giữ self._cond
+        entry = (priority, next(self._seq))
+        heapq.heappush(self._waiters, entry)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            if entry in self._evicted:
+                # Bị request ưu tiên hơn đẩy ra khỏi hàng đợi đầy
+                self._evicted.discard(entry)
+                raise AdmissionRejected("queue_full", self._estimated_wait())
+            if self._active < self.max_concurrent and self._waiters[0] == entry:
+                heapq.heappop(self._waiters)
+                self._active += 1
+                self._counters["admitted"] += 1
+                # Request kế tiếp trong hàng đợi có thể cũng đã có chỗ
+                self._cond.notify_all()
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._counters["shed_timeout"] += 1
+                self._cond.notify_all()
+                raise AdmissionRejected("queue_timeout", self._estimated_wait())
+            self._cond.wait(remaining)
+
+    def _estimated_wait(self) -> float:
+        return self._service_time * (len(self._waiters) + 1) / max(1, self.max_concurrent)
@@ -5,16 +5,18 @@ from langchain.chains import RetrievalQA
 from langchain.vectorstores import ElasticsearchStore
 from langchain.chat_models import ChatOpenAI
 from langchain.embeddings import OpenAIEmbeddings
-from datetime import datetime
-import pytz
 from dotenv import load_dotenv
+from chunking import TokenChunker
+from retrieval import RerankRetriever
+from retrieval_cache import RetrievalCache
+from intents import build_default_router
+from filters import ensure_metadata_mapping, new_upload_metadata, stamp
 from langchain_community.document_loaders import (
     TextLoader,
     PyPDFLoader,
     UnstructuredMarkdownLoader
 )
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import tempfile
 
 
@@ -33,19 +35,17 @@ print("OPENAI_API_KEY:", os.getenv("OPENAI_API_KEY"))
 # Kết nối Elasticsearch
 es = Elasticsearch("http://localhost:9200")
 
+# Metadata (source, batch_id, uploaded_at...) map kiểu keyword/date để lọc trong knn
+ensure_metadata_mapping(es, "chatbot")
+
 # Khởi tạo mô hình gpt-4o-mini từ OpenAI
 llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.7, max_tokens=100) # Điều chỉnh temperature nếu cần
 
 # Khởi tạo bộ tạo embedding bằng OpenAI
 embeddings = OpenAIEmbeddings()
 
-# Khởi tạo text splitter
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len,
-    separators=["\n\n", "\n", " ", ""]
-)
+# Khởi tạo text splitter (theo token tiktoken, giữ cấu trúc tài liệu)
+text_splitter = TokenChunker()
 
 # Kết nối với ElasticsearchStore
 vectorstore = ElasticsearchStore(
@@ -55,12 +55,26 @@ vectorstore = ElasticsearchStore(
     vector_query_field="embedding"
 )
 
+@st.cache_resource
+def get_retrieval_cache():
+    # Giữ cache qua các lần Streamlit chạy lại script
+    return RetrievalCache(es, "chatbot")
+
+retrieval_cache = get_retrieval_cache()
+
 # Tạo retriever từ vectorstore
-retriever = vectorstore.as_retriever()
+retriever = RerankRetriever(es=es, embeddings=embeddings, index_name="chatbot", cache=retrieval_cache)
 
 # Tạo RetrievalQA chain
 qa_chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
 
+@st.cache_resource
+def get_intent_router():
+    # Bộ định tuyến intent tất định, giữ bộ đếm hit qua các lần chạy lại script
+    return build_default_router()
+
+intent_router = get_intent_router()
+
 # Giao diện Streamlit
 st.title("Chatbot AI với OpenAI, LangChain và Elasticsearch")
 
@@ -72,9 +86,19 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True
 )
 
+# Streamlit chạy lại toàn bộ script ở mỗi tin nhắn chat trong khi file_uploader vẫn giữ file:
+# ghi nhớ các file đã index (tên + kích thước) để không index lại và không xoá cache truy xuất
+if "processed_files" not in st.session_state:
+    st.session_state.processed_files = set()
+
 # Process uploaded files
 if uploaded_files:
+    indexed = False
     for uploaded_file in uploaded_files:
+        file_id = (uploaded_file.name, uploaded_file.size)
+        if file_id in st.session_state.processed_files:
+            continue
+
         # Create a temporary file
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
             tmp_file.write(uploaded_file.getvalue())
@@ -87,17 +111,19 @@ if uploaded_files:
             elif uploaded_file.name.endswith('.pdf'):
                 loader = PyPDFLoader(tmp_file_path)
             elif uploaded_file.name.endswith('.docx'):
-                loader = UnstructuredFileLoader(tmp_file_path)
+                loader = UnstructuredFileLoader(tmp_file_path, mode="elements")
             elif uploaded_file.name.endswith('.md'):
-                loader = UnstructuredMarkdownLoader(tmp_file_path)
+                loader = UnstructuredMarkdownLoader(tmp_file_path, mode="elements")
             
             # Load and split the document
             documents = loader.load()
-            splits = text_splitter.split_documents(documents)
+            splits = text_splitter.split_documents(documents, source=uploaded_file.name)
             
             # Add documents to vectorstore
-            vectorstore.add_documents(splits)
+            vectorstore.add_documents(stamp(splits, new_upload_metadata()))
             st.sidebar.success(f"Đã xử lý thành công file: {uploaded_file.name}")
+            st.session_state.processed_files.add(file_id)
+            indexed = True
             
         except Exception as e:
             st.sidebar.error(f"Lỗi khi xử lý file {uploaded_file.name}: {str(e)}")
@@ -105,6 +131,10 @@ if uploaded_files:
             # Clean up temporary file
             os.unlink(tmp_file_path)
 
+    # Index đã thay đổi: bỏ các kết quả truy xuất đã cache
+    if indexed:
+        retrieval_cache.bump_generation()
+
 # Initialize session state for chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -121,50 +151,9 @@ if prompt := st.chat_input("Nhập câu hỏi của bạn"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Check if it's a time-related question
-    time_related_keywords = {
-        "date": ["what day", "what date", "today", "ngày", "thứ", "date"],
-        "time": ["what time", "now", "giờ", "thời gian", "time"]
-    }
-    
-    prompt_lower = prompt.lower()
-    is_date_question = any(keyword in prompt_lower for keyword in time_related_keywords["date"])
-    is_time_question = any(keyword in prompt_lower for keyword in time_related_keywords["time"])
-
-    if is_date_question or is_time_question:
-        vietnam_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        current_time = datetime.now(vietnam_tz)
-        
-        if is_date_question:
-            # Format date in Vietnamese
-            weekday_names = {
-                0: "Thứ Hai",
-                1: "Thứ Ba",
-                2: "Thứ Tư",
-                3: "Thứ Năm",
-                4: "Thứ Sáu",
-                5: "Thứ Bảy",
-                6: "Chủ Nhật"
-            }
-            month_names = {
-                1: "tháng 1",
-                2: "tháng 2",
-                3: "tháng 3",
-                4: "tháng 4",
-                5: "tháng 5",
-                6: "tháng 6",
-                7: "tháng 7",
-                8: "tháng 8",
-                9: "tháng 9",
-                10: "tháng 10",
-                11: "tháng 11",
-                12: "tháng 12"
-            }
-            response = f"Hôm nay là {weekday_names[current_time.weekday()]}, {current_time.day} {month_names[current_time.month]} năm {current_time.year}"
-        else:
-            # Format time in Vietnamese
-            response = f"Bây giờ là {current_time.hour:02d}:{current_time.minute:02d}"
-    else:
+    # Deterministic intents (date/time, ETV address, greetings) are answered without LLM/ES
+    response = intent_router.route(prompt)
+    if response is None:
         # Use Elasticsearch for specific queries
         try:
             response = qa_chain.run(prompt)
@@ -3,9 +3,12 @@ import os
 import tempfile
 import asyncio
 import pickle
-from datetime import datetime
-import pytz
 from dotenv import load_dotenv
+from chunking import TokenChunker
+from retrieval import RerankRetriever
+from retrieval_cache import RetrievalCache
+from intents import build_default_router
+from filters import ensure_metadata_mapping, new_upload_metadata, stamp
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 
@@ -19,7 +22,6 @@ from langchain_community.document_loaders import (
     UnstructuredMarkdownLoader
 )
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 # -------------------- Cấu hình --------------------
 load_dotenv(dotenv_path=".env", override=True)
@@ -36,6 +38,9 @@ except RuntimeError:
 es = Elasticsearch("http://localhost:9200")
 INDEX_NAME = "chatbot"
 
+# Metadata (source, batch_id, uploaded_at...) map kiểu keyword/date để lọc trong knn
+ensure_metadata_mapping(es, INDEX_NAME)
+
 # Thư mục lưu embeddings cục bộ
 EMBEDDING_DIR = "saved_embeddings"
 os.makedirs(EMBEDDING_DIR, exist_ok=True)
@@ -74,12 +79,7 @@ embeddings = GoogleGenerativeAIEmbeddings(
 )
 
 # Text splitter
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len,
-    separators=["\n\n", "\n", " ", ""]
-)
+text_splitter = TokenChunker()
 
 # Kết nối ElasticsearchStore
 vectorstore = ElasticsearchStore(
@@ -89,9 +89,23 @@ vectorstore = ElasticsearchStore(
     vector_query_field="embedding"
 )
 
-retriever = vectorstore.as_retriever()
+@st.cache_resource
+def get_retrieval_cache():
+    # Giữ cache qua các lần Streamlit chạy lại script
+    return RetrievalCache(es, INDEX_NAME)
+
+retrieval_cache = get_retrieval_cache()
+
+retriever = RerankRetriever(es=es, embeddings=embeddings, index_name=INDEX_NAME, cache=retrieval_cache)
 qa_chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
 
+@st.cache_resource
+def get_intent_router():
+    # Bộ định tuyến intent tất định, giữ bộ đếm hit qua các lần chạy lại script
+    return build_default_router()
+
+intent_router = get_intent_router()
+
 # -------------------- Streamlit UI --------------------
 st.title("Chatbot AI với Gemini, LangChain và Elasticsearch")
 st.sidebar.title("Tải lên tài liệu")
@@ -102,9 +116,19 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True
 )
 
+# Streamlit chạy lại toàn bộ script ở mỗi tin nhắn chat trong khi file_uploader vẫn giữ file:
+# ghi nhớ các file đã index (tên + kích thước) để không index lại và không xoá cache truy xuất
+if "processed_files" not in st.session_state:
+    st.session_state.processed_files = set()
+
 # -------------------- Xử lý upload file --------------------
 if uploaded_files:
+    indexed = False
     for uploaded_file in uploaded_files:
+        file_id = (uploaded_file.name, uploaded_file.size)
+        if file_id in st.session_state.processed_files:
+            continue
+
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
             tmp_file.write(uploaded_file.getvalue())
             tmp_file_path = tmp_file.name
@@ -118,30 +142,36 @@ if uploaded_files:
             elif uploaded_file.name.endswith('.pdf'):
                 loader = PyPDFLoader(tmp_file_path)
             elif uploaded_file.name.endswith('.docx'):
-                loader = UnstructuredFileLoader(tmp_file_path)
+                loader = UnstructuredFileLoader(tmp_file_path, mode="elements")
             elif uploaded_file.name.endswith('.md'):
-                loader = UnstructuredMarkdownLoader(tmp_file_path)
+                loader = UnstructuredMarkdownLoader(tmp_file_path, mode="elements")
 
             documents = loader.load()
-            splits = text_splitter.split_documents(documents)
+            splits = text_splitter.split_documents(documents, source=uploaded_file.name)
 
             # Nếu embeddings đã lưu, load từ file
             if os.path.exists(embedding_path):
                 with open(embedding_path, "rb") as f:
                     saved_docs = pickle.load(f)
-                vectorstore.add_documents(saved_docs)
+                vectorstore.add_documents(stamp(saved_docs, new_upload_metadata()))
                 st.sidebar.success(f"Đã load embeddings từ file: {uploaded_file.name}")
             else:
                 # Tạo embeddings mới và lưu
-                vectorstore.add_documents(splits)
+                vectorstore.add_documents(stamp(splits, new_upload_metadata()))
                 with open(embedding_path, "wb") as f:
                     pickle.dump(splits, f)
                 st.sidebar.success(f"Đã xử lý file: {uploaded_file.name} và lưu embeddings")
+            st.session_state.processed_files.add(file_id)
+            indexed = True
         except Exception as e:
             st.sidebar.error(f"Lỗi khi xử lý file {uploaded_file.name}: {str(e)}")
         finally:
             os.unlink(tmp_file_path)
 
+    # Index đã thay đổi: bỏ các kết quả truy xuất đã cache
+    if indexed:
+        retrieval_cache.bump_generation()
+
 # -------------------- Hiển thị document đã lưu --------------------
 st.sidebar.subheader("Danh sách document đã lưu trong Elasticsearch")
 
@@ -169,25 +199,9 @@ if prompt := st.chat_input("Nhập câu hỏi của bạn"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Kiểm tra câu hỏi về thời gian
-    time_keywords = {"date": ["what day", "what date", "today", "ngày", "thứ", "date"],
-                     "time": ["what time", "now", "giờ", "thời gian", "time"]}
-    
-    prompt_lower = prompt.lower()
-    is_date = any(k in prompt_lower for k in time_keywords["date"])
-    is_time = any(k in prompt_lower for k in time_keywords["time"])
-
-    if is_date or is_time:
-        tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        now = datetime.now(tz)
-        if is_date:
-            weekdays = ["Thứ Hai","Thứ Ba","Thứ Tư","Thứ Năm","Thứ Sáu","Thứ Bảy","Chủ Nhật"]
-            months = [None,"tháng 1","tháng 2","tháng 3","tháng 4","tháng 5","tháng 6",
-                      "tháng 7","tháng 8","tháng 9","tháng 10","tháng 11","tháng 12"]
-            response = f"Hôm nay là {weekdays[now.weekday()]}, {now.day} {months[now.month]} năm {now.year}"
-        else:
-            response = f"Bây giờ là {now.hour:02d}:{now.minute:02d}"
-    else:
+    # Intent tất định (ngày/giờ, địa chỉ ETV, lời chào): trả lời ngay, không gọi LLM/ES
+    response = intent_router.route(prompt)
+    if response is None:
         try:
             vietnamese_prompt = f"Hãy trả lời bằng tiếng Việt: {prompt}"
             response = qa_chain.run(vietnamese_prompt)
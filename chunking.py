@@ -0,0 +1,296 @@
+# chunking.py
+# Chia tài liệu theo số token (tiktoken) thay vì số ký tự, tôn trọng cấu trúc:
+# heading markdown, ranh giới trang PDF và các section DOCX.
+# Mỗi chunk mang metadata source/page/heading; header/footer lặp lại giữa các trang bị loại bỏ.
+import hashlib
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import tiktoken
+from langchain_core.documents import Document
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…;:])\s+")
+# Chỉ số trang được coi là phần thay đổi của header/footer ("Trang 3/5", "Page 3 of 5", "- 3 -");
+# các số khác (số liệu trong bảng) vẫn giữ nguyên khi so sánh
+_PAGE_LABEL_RE = re.compile(r"(?<!\w)(?:trang|page)\s*\d+(?:\s*(?:/|of|trên)\s*\d+)?(?!\w)", re.IGNORECASE)
+_BARE_PAGE_RE = re.compile(r"^[-–\s]*\d+(?:\s*/\s*\d+)?[-–\s]*$")
+
+# Một dòng đầu/cuối trang là boilerplate khi lặp lại ở ít nhất tỉ lệ này số trang của cùng file
+_BOILERPLATE_MIN_PAGES = 3
+_BOILERPLATE_RATIO = 0.6
+# Số dòng đầu/cuối mỗi trang được xét là header/footer
+_EDGE_LINES = 2
+# Trang ngắn hơn số dòng này không tách được header/footer khỏi nội dung, không xét
+_MIN_PAGE_LINES = 2 * _EDGE_LINES + 2
+_MAX_BOILERPLATE_CHARS = 150
+# Các loại phần tử unstructured không mang nội dung
+_SKIPPED_CATEGORIES = {"Header", "Footer", "PageBreak"}
+
+
+class TokenChunker:
+    def __init__(
+        self,
+        chunk_tokens: int = CHUNK_TOKENS,
+        overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+        encoding_name: str = "cl100k_base",
+    ):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens phải nhỏ hơn chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    # -------------------- API chính --------------------
+    def split_documents(self, documents: Iterable[Document], source: Optional[str] = None) -> List[Document]:
+        # source: tên file gốc, vì loader chỉ thấy đường dẫn file tạm
+        documents = _strip_boilerplate(list(documents))
+        chunks: List[Document] = []
+        seen = set()
+        for text, metadata in _sections(documents):
+            if source:
+                metadata = {**metadata, "source": source}
+            for piece in self.split_text(text):
+                # Bỏ các chunk trùng lặp y hệt (ví dụ trang bìa lặp lại)
+                digest = hashlib.sha1(" ".join(piece.split()).lower().encode("utf-8")).hexdigest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                chunks.append(Document(page_content=piece, metadata=dict(metadata)))
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        chunks: List[str] = []
+        current: List[_Unit] = []
+        size = 0
+        for unit in self._units(text):
+            if current and size + unit.n_tokens > self.chunk_tokens:
+                chunks.append(_join(current))
+                current, size = self._overlap_tail(current)
+                if size + unit.n_tokens > self.chunk_tokens:
+                    # Overlap cộng đơn vị mới vượt ngân sách: bỏ overlap, không để chunk sau
+                    # vượt chunk_tokens hay sinh chunk chỉ chứa phần overlap
+                    current, size = [], 0
+            current.append(unit)
+            size += unit.n_tokens
+        if current:
+            chunks.append(_join(current))
+        return [c for c in chunks if c.strip()]
+
+    # -------------------- Nội bộ --------------------
+    def _units(self, text: str) -> List["_Unit"]:
+        # Đoạn văn -> câu -> cửa sổ token, chỉ chia nhỏ hơn khi cần
+        units: List[_Unit] = []
+        for paragraph in re.split(r"\n\s*\n", text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            n_tokens = self.count_tokens(paragraph)
+            if n_tokens <= self.chunk_tokens:
+                units.append(_Unit(paragraph, n_tokens, True))
+                continue
+            first = True
+            for sentence in _SENTENCE_RE.split(paragraph):
+                n_tokens = self.count_tokens(sentence)
+                if n_tokens <= self.chunk_tokens:
+                    units.append(_Unit(sentence, n_tokens, first))
+                else:
+                    windows = self._token_windows(sentence)
+                    units.extend(_Unit(w, n, first and i == 0) for i, (w, n) in enumerate(windows))
+                first = False
+        return units
+
+    def _token_windows(self, text: str) -> List[Tuple[str, int]]:
+        # Gom theo từ rồi đếm token, không cắt dãy token id: một chữ có dấu thường gồm
+        # nhiều token byte, cắt giữa chừng sẽ decode ra ký tự lỗi (U+FFFD)
+        windows: List[Tuple[str, int]] = []
+        current: List[str] = []
+        size = 0
+        for piece in self._word_pieces(text):
+            n_tokens = self.count_tokens(piece)
+            if current and size + n_tokens > self.chunk_tokens:
+                windows.append(self._window("".join(current)))
+                current, size = [], 0
+            current.append(piece)
+            size += n_tokens
+        if current:
+            windows.append(self._window("".join(current)))
+        return windows
+
+    def _word_pieces(self, text: str) -> Iterable[str]:
+        for piece in re.findall(r"\s*\S+", text):
+            if self.count_tokens(piece) <= self.chunk_tokens:
+                yield piece
+                continue
+            # Một "từ" dài hơn cả chunk (URL, chuỗi mã hoá...): cắt theo ký tự,
+            # mỗi ký tự tối đa 4 byte nên tối đa 4 token
+            step = max(1, self.chunk_tokens // 4)
+            for i in range(0, len(piece), step):
+                yield piece[i:i + step]
+
+    def _window(self, text: str) -> Tuple[str, int]:
+        text = text.strip()
+        return text, self.count_tokens(text)
+
+    def _overlap_tail(self, units: List["_Unit"]) -> Tuple[List["_Unit"], int]:
+        # Giữ lại các đơn vị cuối (nguyên câu/đoạn) vừa trong ngân sách overlap
+        tail: List[_Unit] = []
+        size = 0
+        for unit in reversed(units):
+            if size + unit.n_tokens > self.overlap_tokens:
+                break
+            tail.insert(0, unit)
+            size += unit.n_tokens
+        return tail, size
+
+
+class _Unit(NamedTuple):
+    text: str
+    n_tokens: int
+    # True nếu đơn vị bắt đầu một đoạn văn mới
+    new_paragraph: bool
+
+
+def _join(units: List[_Unit]) -> str:
+    parts: List[str] = []
+    for i, unit in enumerate(units):
+        if i:
+            parts.append("\n\n" if unit.new_paragraph else " ")
+        parts.append(unit.text)
+    return "".join(parts)
+
+
+def _base_metadata(doc: Document) -> Dict:
+    metadata = {"source": os.path.basename(_source_of(doc))}
+    page = _page_of(doc)
+    if page is not None:
+        metadata["page"] = page
+    return metadata
+
+
+def _sections(documents: List[Document]) -> Iterable[Tuple[str, Dict]]:
+    # Tài liệu tải bằng mode="elements" của unstructured (DOCX/MD): gom các phần tử theo Title
+    if documents and all("category" in (d.metadata or {}) for d in documents):
+        yield from _element_sections(documents)
+        return
+    for doc in documents:
+        yield from _markdown_sections(doc.page_content, _base_metadata(doc))
+
+
+def _element_sections(elements: List[Document]) -> Iterable[Tuple[str, Dict]]:
+    heading: Optional[str] = None
+    buffer: List[str] = []
+    metadata: Dict = {}
+    for element in elements:
+        if element.metadata.get("category") in _SKIPPED_CATEGORIES:
+            continue
+        element_meta = _base_metadata(element)
+        is_title = element.metadata.get("category") == "Title"
+        new_page = buffer and element_meta.get("page") != metadata.get("page")
+        if buffer and (is_title or new_page):
+            yield "\n\n".join(buffer), metadata
+            buffer = []
+        if is_title:
+            heading = element.page_content.strip()
+        if not buffer:
+            metadata = dict(element_meta)
+            if heading:
+                metadata["heading"] = heading
+        if element.page_content.strip():
+            buffer.append(element.page_content.strip())
+    if buffer:
+        yield "\n\n".join(buffer), metadata
+
+
+def _markdown_sections(text: str, metadata: Dict) -> Iterable[Tuple[str, Dict]]:
+    heading: Optional[str] = None
+    buffer: List[str] = []
+    for line in text.splitlines():
+        match = _HEADING_RE.match(line)
+        if match:
+            if "".join(buffer).strip():
+                yield "\n".join(buffer), _with_heading(metadata, heading)
+            heading = match.group(2)
+            buffer = [line]
+        else:
+            buffer.append(line)
+    if "".join(buffer).strip():
+        yield "\n".join(buffer), _with_heading(metadata, heading)
+
+
+def _with_heading(metadata: Dict, heading: Optional[str]) -> Dict:
+    if not heading:
+        return metadata
+    return {**metadata, "heading": heading}
+
+
+def _strip_boilerplate(documents: List[Document]) -> List[Document]:
+    # mode="elements": mỗi phần tử không phải một trang, và Header/Footer đã bị bỏ theo category
+    if any("category" in (doc.metadata or {}) for doc in documents):
+        return documents
+    # Đếm các dòng (bỏ số trang) lặp lại trên nhiều trang khác nhau của cùng một file
+    lines_by_page: Dict[str, Dict[int, set]] = defaultdict(lambda: defaultdict(set))
+    for doc in documents:
+        page = _page_of(doc)
+        if page is None:
+            continue
+        lines_by_page[_source_of(doc)][page].update(_line_key(line) for line in _edge_lines(doc.page_content))
+
+    boilerplate: Dict[str, set] = {}
+    for source, pages in lines_by_page.items():
+        if len(pages) < _BOILERPLATE_MIN_PAGES:
+            continue
+        counts = Counter()
+        for keys in pages.values():
+            counts.update(keys)
+        threshold = max(_BOILERPLATE_MIN_PAGES, _BOILERPLATE_RATIO * len(pages))
+        boilerplate[source] = {key for key, n in counts.items() if n >= threshold}
+
+    if not any(boilerplate.values()):
+        return documents
+
+    cleaned = []
+    for doc in documents:
+        repeated = boilerplate.get(_source_of(doc))
+        if repeated:
+            edges = set(_edge_lines(doc.page_content))
+            lines = [
+                line for line in doc.page_content.splitlines()
+                if line not in edges or _line_key(line) not in repeated
+            ]
+            doc = Document(page_content="\n".join(lines), metadata=doc.metadata)
+        cleaned.append(doc)
+    return cleaned
+
+
+def _source_of(doc: Document) -> str:
+    return str(doc.metadata.get("source") or doc.metadata.get("filename") or "")
+
+
+def _page_of(doc: Document) -> Optional[int]:
+    page = doc.metadata.get("page", doc.metadata.get("page_number"))
+    return None if page is None else int(page)
+
+
+def _edge_lines(text: str) -> List[str]:
+    # Header/footer chỉ nằm ở vài dòng đầu và cuối trang
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) < _MIN_PAGE_LINES:
+        return []
+    edges = lines[:_EDGE_LINES] + lines[-_EDGE_LINES:]
+    return [line for line in edges if len(line) <= _MAX_BOILERPLATE_CHARS]
+
+
+def _line_key(line: str) -> str:
+    line = " ".join(line.split()).lower()
+    if _BARE_PAGE_RE.match(line):
+        return "#"
+    return _PAGE_LABEL_RE.sub("#", line)
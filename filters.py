@@ -0,0 +1,101 @@
+# filters.py
+# Lọc theo metadata cho truy xuất: các trường metadata được map kiểu keyword/date
+# để dùng làm mệnh đề `filter` bên trong truy vấn knn (lọc trước, không phải lọc sau top-k).
+import logging
+import uuid
+from datetime import date, datetime, timezone
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+METADATA_MAPPING = {
+    "properties": {
+        "metadata": {
+            "properties": {
+                "source": {"type": "keyword"},
+                "page": {"type": "integer"},
+                "heading": {"type": "keyword"},
+                "batch_id": {"type": "keyword"},
+                "uploaded_at": {"type": "date"},
+            }
+        }
+    }
+}
+
+
+def ensure_metadata_mapping(es, index_name: str) -> None:
+    """Đảm bảo metadata được map kiểu keyword/date cho index mới và (nếu được) index đã có."""
+    # Index template áp dụng khi index được tạo, kể cả khi ElasticsearchStore tự tạo
+    try:
+        es.indices.put_index_template(
+            name=f"{index_name}-metadata",
+            index_patterns=[index_name],
+            priority=100,
+            template={"mappings": METADATA_MAPPING},
+        )
+    except Exception as e:
+        logger.warning("Không tạo được index template cho %s: %s", index_name, e)
+
+    # Index đã có: chỉ thêm được các trường chưa map; trường đã map kiểu khác thì giữ nguyên
+    try:
+        if es.indices.exists(index=index_name):
+            es.indices.put_mapping(index=index_name, body=METADATA_MAPPING)
+    except Exception as e:
+        logger.warning(
+            "Metadata của index %s đã được map kiểu khác, cần tạo lại index để lọc chính xác: %s",
+            index_name, e,
+        )
+
+
+def new_upload_metadata() -> dict:
+    """Metadata gắn cho mọi chunk của một lần upload."""
+    return {
+        "batch_id": uuid.uuid4().hex,
+        "uploaded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def stamp(documents, upload_metadata: dict):
+    for doc in documents:
+        doc.metadata.update(upload_metadata)
+    return documents
+
+
+def parse_upload_time(value: Optional[str]) -> Optional[str]:
+    """Chuẩn hoá mốc thời gian upload (ISO 8601, ngày hoặc ngày giờ); raise ValueError nếu sai."""
+    if value is None:
+        return None
+    text = value.strip()
+    try:
+        if len(text) == 10:
+            return date.fromisoformat(text).isoformat()
+        return datetime.fromisoformat(text.replace("Z", "+00:00")).isoformat()
+    except ValueError:
+        raise ValueError(
+            f"Thời gian không hợp lệ: {value!r} (cần ISO 8601, ví dụ 2024-05-31 hoặc 2024-05-31T08:00:00)"
+        ) from None
+
+
+def build_filters(
+    source: Optional[str] = None,
+    batch_id: Optional[str] = None,
+    uploaded_from: Optional[str] = None,
+    uploaded_to: Optional[str] = None,
+) -> List[dict]:
+    """Các mệnh đề filter của Elasticsearch; danh sách rỗng nghĩa là không lọc."""
+    clauses: List[dict] = []
+    if source:
+        clauses.append({"term": {"metadata.source": source}})
+    if batch_id:
+        clauses.append({"term": {"metadata.batch_id": batch_id}})
+    uploaded_from = parse_upload_time(uploaded_from)
+    uploaded_to = parse_upload_time(uploaded_to)
+    if uploaded_from or uploaded_to:
+        date_range = {}
+        if uploaded_from:
+            date_range["gte"] = uploaded_from
+        if uploaded_to:
+            # Chỉ có ngày (2024-05-31): làm tròn lên cuối ngày, không thì lte dừng ở 00:00
+            date_range["lte"] = uploaded_to if "T" in uploaded_to else f"{uploaded_to}||/d"
+        clauses.append({"range": {"metadata.uploaded_at": date_range}})
+    return clauses
@@ -2,10 +2,8 @@ import streamlit as st
 import os
 import tempfile
 import asyncio
-from datetime import datetime
-import pytz
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
 from langchain_google_genai.chat_models import ChatGoogleGenerativeAI
 from langchain_community.document_loaders import (
     TextLoader,
@@ -13,6 +11,12 @@ from langchain_community.document_loaders import (
     UnstructuredMarkdownLoader
 )
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
+from chunking import TokenChunker
+from retrieval import select_passages
+from retrieval_cache import RetrievalCache
+from intents import build_default_router
+from filters import ensure_metadata_mapping, new_upload_metadata, stamp
+from vi_analysis import LEXICAL_FETCH_K, content_query, create_content_index, normalize_text
 
 # -------------------- Cấu hình --------------------
 load_dotenv(dotenv_path=".env", override=True)
@@ -29,18 +33,21 @@ except RuntimeError:
 es = Elasticsearch("http://localhost:9200")
 INDEX_NAME = "chatbot"
 
-# Tạo index nếu chưa có
-if not es.indices.exists(index=INDEX_NAME):
-    es.indices.create(
-        index=INDEX_NAME,
-        body={
-            "mappings": {
-                "properties": {
-                    "content": {"type": "text"}
-                }
-            }
-        }
-    )
+# Metadata (source, batch_id, uploaded_at...) map kiểu keyword/date để lọc trong knn
+ensure_metadata_mapping(es, INDEX_NAME)
+
+# Tạo index nếu chưa có: content kèm subfield bỏ dấu và cặp âm tiết (vi_analysis.py)
+create_content_index(es, INDEX_NAME)
+
+@st.cache_resource
+def get_retrieval_cache():
+    # Giữ cache qua các lần Streamlit chạy lại script
+    return RetrievalCache(es, INDEX_NAME)
+
+retrieval_cache = get_retrieval_cache()
+
+# Chia tài liệu theo token, giữ cấu trúc trang/heading thay vì lưu nguyên tài liệu
+text_splitter = TokenChunker()
 
 # -------------------- Khởi tạo LLM --------------------
 llm = ChatGoogleGenerativeAI(
@@ -49,6 +56,13 @@ llm = ChatGoogleGenerativeAI(
     google_api_key=GOOGLE_API_KEY
 )
 
+@st.cache_resource
+def get_intent_router():
+    # Bộ định tuyến intent tất định, giữ bộ đếm hit qua các lần chạy lại script
+    return build_default_router()
+
+intent_router = get_intent_router()
+
 # -------------------- Streamlit UI --------------------
 st.title("🤖 Chatbot AI với Gemini & Elasticsearch")
 st.sidebar.title("📂 Tải lên tài liệu")
@@ -59,9 +73,19 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True
 )
 
+# Streamlit chạy lại toàn bộ script ở mỗi tin nhắn chat trong khi file_uploader vẫn giữ file:
+# ghi nhớ các file đã index (tên + kích thước) để không index lại và không xoá cache truy xuất
+if "processed_files" not in st.session_state:
+    st.session_state.processed_files = set()
+
 # -------------------- Xử lý upload file --------------------
 if uploaded_files:
+    indexed = False
     for uploaded_file in uploaded_files:
+        file_id = (uploaded_file.name, uploaded_file.size)
+        if file_id in st.session_state.processed_files:
+            continue
+
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
             tmp_file.write(uploaded_file.getvalue())
             tmp_file_path = tmp_file.name
@@ -73,21 +97,35 @@ if uploaded_files:
             elif uploaded_file.name.endswith('.pdf'):
                 loader = PyPDFLoader(tmp_file_path)
             elif uploaded_file.name.endswith('.docx'):
-                loader = UnstructuredFileLoader(tmp_file_path)
+                loader = UnstructuredFileLoader(tmp_file_path, mode="elements")
             elif uploaded_file.name.endswith('.md'):
-                loader = UnstructuredMarkdownLoader(tmp_file_path)
+                loader = UnstructuredMarkdownLoader(tmp_file_path, mode="elements")
 
             documents = loader.load()
-            for doc in documents:
-                content = getattr(doc, "page_content", str(doc))
-                es.index(index=INDEX_NAME, document={"content": content})
+            splits = stamp(text_splitter.split_documents(documents, source=uploaded_file.name), new_upload_metadata())
+            # Một bulk request cho cả file; refresh=True để chunk mới tìm được ngay trước khi
+            # bump generation, tránh cache kết quả cũ dưới generation mới
+            helpers.bulk(
+                es,
+                (
+                    {"_index": INDEX_NAME, "content": normalize_text(chunk.page_content), "metadata": chunk.metadata}
+                    for chunk in splits
+                ),
+                refresh=True,
+            )
 
             st.sidebar.success(f"✅ Đã xử lý file: {uploaded_file.name} và lưu vào Elasticsearch")
+            st.session_state.processed_files.add(file_id)
+            indexed = True
         except Exception as e:
             st.sidebar.error(f"❌ Lỗi khi xử lý file {uploaded_file.name}: {str(e)}")
         finally:
             os.unlink(tmp_file_path)
 
+    # Index đã thay đổi: bỏ các kết quả truy xuất đã cache
+    if indexed:
+        retrieval_cache.bump_generation()
+
 # -------------------- Hiển thị document đã lưu --------------------
 st.sidebar.subheader("📑 Danh sách document đã lưu trong Elasticsearch")
 if st.sidebar.button("Cập nhật danh sách"):
@@ -141,39 +179,25 @@ if prompt := st.chat_input("Nhập câu hỏi của bạn"):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    response = ""
-
-    # Kiểm tra câu hỏi về thời gian
-    time_keywords = {"date": ["what day", "what date", "today", "ngày", "thứ", "date"],
-                     "time": ["what time", "now", "giờ", "thời gian", "time"]}
-    
-    prompt_lower = prompt.lower()
-    is_date = any(k in prompt_lower for k in time_keywords["date"])
-    is_time = any(k in prompt_lower for k in time_keywords["time"])
-
-    if is_date or is_time:
-        tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        now = datetime.now(tz)
-        weekdays = ["Thứ Hai","Thứ Ba","Thứ Tư","Thứ Năm","Thứ Sáu","Thứ Bảy","Chủ Nhật"]
-        months = [None,"tháng 1","tháng 2","tháng 3","tháng 4","tháng 5","tháng 6",
-                  "tháng 7","tháng 8","tháng 9","tháng 10","tháng 11","tháng 12"]
-
-        date_str = f"{weekdays[now.weekday()]}, {now.day} {months[now.month]} năm {now.year}"
-        time_str = f"{now.hour:02d}:{now.minute:02d}:{now.second:02d} {tz.zone}"
-
-        if is_date and is_time:
-            response = f"📅 Hôm nay là {date_str} và ⏰ hiện tại là {time_str}"
-        elif is_date:
-            response = f"📅 Hôm nay là {date_str}"
-        else:
-            response = f"⏰ Bây giờ là {time_str}"
-
-    # Nếu không phải câu hỏi về thời gian, mới gọi LLM + Elasticsearch
+    # Intent tất định (ngày/giờ, địa chỉ ETV, lời chào): trả lời ngay, không gọi LLM/ES
+    response = intent_router.route(prompt) or ""
+
+    # Nếu không khớp intent tất định, mới gọi LLM + Elasticsearch
     if not response:
         try:
-            query = {"query": {"match": {"content": prompt}}}
-            res = es.search(index=INDEX_NAME, body=query, size=5)
-            context_text = "\n\n".join(hit["_source"]["content"] for hit in res["hits"]["hits"])
+            # Khớp có dấu/không dấu và theo cặp âm tiết nên chỉ cần ít ứng viên,
+            # rồi chỉ giữ vài đoạn liên quan, không trùng lặp
+            query = {"query": content_query(prompt), "_source": ["content"]}
+            cache_key = retrieval_cache.hits_key(prompt, LEXICAL_FETCH_K)
+            generation = retrieval_cache.generation.current()
+            passages = retrieval_cache.get_hits(cache_key)
+            if passages is None:
+                res = es.search(index=INDEX_NAME, body=query, size=LEXICAL_FETCH_K)
+                hits = res["hits"]["hits"]
+                candidates = [hit["_source"]["content"] for hit in hits]
+                passages = select_passages(prompt, candidates, scores=[hit["_score"] for hit in hits])
+                retrieval_cache.put_hits(cache_key, passages, generation)
+            context_text = "\n\n".join(passages)
 
             if context_text.strip():
                 full_prompt = f"""
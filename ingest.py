@@ -0,0 +1,226 @@
+# ingest.py
+# Nạp tài liệu dùng chung: chọn loader theo đuôi file, và ingest hàng loạt nhiều file
+# hoặc archive zip/tar. Các member của archive được stream ra file tạm từng cái một
+# (không giải nén cả archive vào bộ nhớ), parse + chia chunk song song trên nhiều tiến trình,
+# rồi chunk của mọi file được gộp chung vào các batch embedding và bulk index.
+import multiprocessing
+import os
+import tarfile
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from langchain_community.document_loaders import (
+    TextLoader,
+    PyPDFLoader,
+    UnstructuredMarkdownLoader
+)
+from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
+from langchain_core.documents import Document
+
+from chunking import TokenChunker
+from filters import stamp
+from profiler import stage
+
+SUPPORTED_EXTENSIONS = {".txt", ".pdf", ".docx", ".md"}
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2)))
+# Số chunk mỗi lần gọi embedding + bulk index, và số batch chạy song song
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH", "256"))
+EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+MAX_MEMBER_BYTES = int(os.getenv("INGEST_MAX_FILE_MB", "50")) * 1024 * 1024
+# Giới hạn cho cả một lần upload, để archive có hàng nghìn member không làm đầy ổ đĩa tạm
+MAX_BATCH_FILES = int(os.getenv("INGEST_MAX_FILES", "500"))
+MAX_BATCH_BYTES = int(os.getenv("INGEST_MAX_TOTAL_MB", "1024")) * 1024 * 1024
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_chunker: Optional[TokenChunker] = None
+
+
+def load_file(path: str, filename: str) -> List[Document]:
+    """Đọc một file bằng loader phù hợp; raise ValueError nếu định dạng không hỗ trợ."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".txt":
+        loader = TextLoader(path)
+    elif ext == ".pdf":
+        loader = PyPDFLoader(path)
+    elif ext == ".docx":
+        loader = UnstructuredFileLoader(path, mode="elements")
+    elif ext == ".md":
+        loader = UnstructuredMarkdownLoader(path, mode="elements")
+    else:
+        raise ValueError("Unsupported file type")
+    return loader.load()
+
+
+def parse_and_split(path: str, filename: str) -> List[Document]:
+    # Chạy trong tiến trình con: mỗi tiến trình giữ một TokenChunker riêng
+    global _chunker
+    if _chunker is None:
+        _chunker = TokenChunker()
+    return _chunker.split_documents(load_file(path, filename), source=filename)
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+# -------------------- Giải nén dạng stream --------------------
+def collect_members(
+    uploads: Iterable[Tuple[str, BinaryIO]], tmpdir: str
+) -> Tuple[List[Tuple[str, str]], List[dict]]:
+    """Ghi từng file (hoặc member của archive) ra tmpdir.
+
+    Trả về danh sách (tên file, đường dẫn tạm) cần ingest và báo cáo cho các file bị bỏ qua,
+    kể cả các file vượt giới hạn số file (MAX_BATCH_FILES) hoặc tổng dung lượng (MAX_BATCH_BYTES).
+    """
+    members: List[Tuple[str, str]] = []
+    skipped: List[dict] = []
+    total_bytes = 0
+    for filename, fileobj in uploads:
+        try:
+            if filename.lower().endswith(".zip"):
+                entries = _zip_members(fileobj)
+            elif is_archive(filename):
+                entries = _tar_members(fileobj)
+            else:
+                entries = iter([(filename, fileobj)])
+            for name, stream in entries:
+                if os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    skipped.append(_report(name, "skipped", error="Unsupported file type"))
+                    continue
+                if len(members) >= MAX_BATCH_FILES:
+                    skipped.append(_report(name, "skipped", error=f"Vượt quá giới hạn {MAX_BATCH_FILES} file mỗi lần upload"))
+                    continue
+                remaining = MAX_BATCH_BYTES - total_bytes
+                try:
+                    path, size = _spool(stream, name, tmpdir, min(MAX_MEMBER_BYTES, remaining))
+                except ValueError as e:
+                    if remaining < MAX_MEMBER_BYTES:
+                        error = f"Vượt quá tổng dung lượng {MAX_BATCH_BYTES // (1024 * 1024)} MB mỗi lần upload"
+                        skipped.append(_report(name, "skipped", error=error))
+                    else:
+                        skipped.append(_report(name, "error", error=str(e)))
+                    continue
+                total_bytes += size
+                members.append((name, path))
+        except Exception as e:
+            # Archive hỏng hoặc không đọc được: báo lỗi cho cả archive
+            skipped.append(_report(filename, "error", error=str(e)))
+    return members, skipped
+
+
+def _zip_members(fileobj: BinaryIO):
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as stream:
+                yield info.filename, stream
+
+
+def _tar_members(fileobj: BinaryIO):
+    # Chế độ "r|*": đọc tuần tự, không cần seek và không nạp cả archive vào bộ nhớ
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            yield info.name, archive.extractfile(info)
+
+
+def _spool(stream: BinaryIO, name: str, tmpdir: str, limit: int) -> Tuple[str, int]:
+    """Ghi stream ra file tạm, trả về (đường dẫn, số byte); raise ValueError nếu vượt limit."""
+    # Tên file tạm do tempfile sinh ra, không dùng đường dẫn trong archive (tránh path traversal)
+    suffix = os.path.splitext(name)[1].lower()
+    with tempfile.NamedTemporaryFile(delete=False, dir=tmpdir, suffix=suffix) as tmp_file:
+        # Copy từng khối 1 MB, dừng ngay khi vượt giới hạn (chống zip bomb)
+        written = 0
+        while True:
+            block = stream.read(1024 * 1024)
+            if not block:
+                break
+            written += len(block)
+            if written > limit:
+                break
+            tmp_file.write(block)
+    if written > limit:
+        # Xoá ngay phần đã ghi, không đợi TemporaryDirectory dọn
+        os.unlink(tmp_file.name)
+        raise ValueError(f"{name} vượt quá giới hạn {MAX_MEMBER_BYTES // (1024 * 1024)} MB")
+    return tmp_file.name, written
+
+
+# -------------------- Ingest song song --------------------
+def ingest_batch(members: List[Tuple[str, str]], vectorstore, upload_metadata: dict) -> List[dict]:
+    """Parse song song, gộp chunk của mọi file vào batch embedding/bulk chung; trả về báo cáo theo file."""
+    reports: Dict[int, dict] = {}
+    chunks: List[Tuple[int, Document]] = []
+
+    with stage("parse_split", files=len(members)):
+        pool = _get_pool()
+        futures = [pool.submit(parse_and_split, path, name) for name, path in members]
+        for i, ((name, _), future) in enumerate(zip(members, futures)):
+            try:
+                docs = stamp(future.result(), upload_metadata)
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    # Một tiến trình con bị chết: tạo pool mới cho lần sau
+                    _reset_pool(pool)
+                reports[i] = _report(name, "error", error=str(e))
+                continue
+            reports[i] = _report(name, "indexed", chunks=len(docs))
+            chunks.extend((i, doc) for doc in docs)
+
+    batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    with stage("embed_index", chunks=len(chunks), batches=len(batches)):
+        with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+            results = executor.map(lambda batch: _index_batch(vectorstore, batch), batches)
+            for batch, error in zip(batches, results):
+                if error is None:
+                    continue
+                # Batch lỗi: mọi file có chunk trong batch đó bị đánh dấu lỗi
+                for i in {file_index for file_index, _ in batch}:
+                    reports[i].update(status="error", error=error)
+
+    return [reports[i] for i in range(len(members))]
+
+
+def _index_batch(vectorstore, batch: List[Tuple[int, Document]]) -> Optional[str]:
+    try:
+        vectorstore.add_documents([doc for _, doc in batch])
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn thay vì fork: tiến trình uvicorn có nhiều thread, fork có thể kẹt lock
+            _pool = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        # Chỉ bỏ đúng pool đã hỏng; pool mới do request khác vừa tạo vẫn giữ nguyên
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _report(filename: str, status: str, chunks: int = 0, error: Optional[str] = None) -> dict:
+    report = {"file": filename, "status": status, "chunks": chunks}
+    if error:
+        report["error"] = error
+    return report
@@ -0,0 +1,212 @@
+# intents.py
+# Bộ định tuyến intent tất định dùng chung cho mọi entry point: một regex biên dịch sẵn
+# (có biên từ, không khớp chuỗi con như "now" trong "know") và registry các handler
+# trả lời ngay mà không cần gọi LLM hay Elasticsearch.
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+import pytz
+
+TIMEZONE = pytz.timezone("Asia/Ho_Chi_Minh")
+
+WEEKDAYS = ["Thứ Hai", "Thứ Ba", "Thứ Tư", "Thứ Năm", "Thứ Sáu", "Thứ Bảy", "Chủ Nhật"]
+
+ETV_ADDRESS = (
+    "ETV – Viện Kiểm định Công nghệ và Môi trường có trụ sở tại "
+    "Khu C3-2B/NO4, phường Thạch Bàn, Quận Long Biên, Hà Nội."
+)
+
+Handler = Callable[[str], str]
+
+
+def _phrase(text: str) -> str:
+    # Khớp nguyên cụm từ: không đứng liền trước/sau một ký tự chữ (Unicode)
+    return r"(?<!\w)" + r"\s+".join(re.escape(word) for word in text.split()) + r"(?!\w)"
+
+
+class IntentRouter:
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self._patterns: Dict[str, str] = {}
+        self._regex: Optional[re.Pattern] = None
+        self._lock = threading.Lock()
+        self._hits: Counter = Counter()
+        self._total = 0
+
+    def register(
+        self,
+        name: str,
+        handler: Handler,
+        phrases: Iterable[str] = (),
+        regex: Optional[str] = None,
+    ) -> None:
+        """Đăng ký một intent bằng danh sách cụm từ (tự thêm biên từ) và/hoặc một regex thô."""
+        alternatives = [_phrase(p) for p in phrases]
+        if regex:
+            alternatives.append(regex)
+        if not alternatives:
+            raise ValueError(f"Intent {name!r} cần ít nhất một cụm từ hoặc regex")
+        if not name.isidentifier():
+            raise ValueError(f"Tên intent không hợp lệ: {name!r}")
+        self._handlers[name] = handler
+        self._patterns[name] = "|".join(alternatives)
+        self._regex = None
+
+    def _compiled(self) -> re.Pattern:
+        if self._regex is None:
+            self._regex = re.compile(
+                "|".join(f"(?P<{name}>{pattern})" for name, pattern in self._patterns.items()),
+                re.IGNORECASE,
+            )
+        return self._regex
+
+    def match(self, message: str) -> List[str]:
+        found = {m.lastgroup for m in self._compiled().finditer(message)}
+        # Giữ thứ tự đăng ký để câu trả lời ghép ổn định (ví dụ ngày trước giờ)
+        return [name for name in self._handlers if name in found]
+
+    def route(self, message: str) -> Optional[str]:
+        """Trả lời ngay nếu khớp intent tất định, ngược lại None (đi tiếp đến LLM)."""
+        names = self.match(message)
+        with self._lock:
+            self._total += 1
+            self._hits.update(names or ["_miss"])
+        if not names:
+            return None
+        return "\n".join(self._handlers[name](message) for name in names)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._total
+            hits = dict(self._hits)
+        misses = hits.pop("_miss", 0)
+        return {
+            "total": total,
+            "hits": hits,
+            "hit_rate": round((total - misses) / total, 4) if total else 0.0,
+        }
+
+
+# -------------------- Handler mặc định --------------------
+def _date_answer(_: str) -> str:
+    now = datetime.now(TIMEZONE)
+    return f"Hôm nay là {WEEKDAYS[now.weekday()]}, {now.day} tháng {now.month} năm {now.year}"
+
+
+def _time_answer(_: str) -> str:
+    now = datetime.now(TIMEZONE)
+    return f"Bây giờ là {now.hour:02d}:{now.minute:02d}"
+
+
+def _etv_contact_answer(_: str) -> str:
+    return ETV_ADDRESS
+
+
+def _greeting_answer(_: str) -> str:
+    return "Xin chào 👋, mình có thể giúp gì cho bạn?"
+
+
+# "ngày mấy" / "thứ mấy" chỉ là câu hỏi về hôm nay khi đứng liền "hôm nay" / "bây giờ";
+# "Hạn nộp hồ sơ là ngày bao nhiêu?" là câu hỏi về tài liệu
+_TODAY = r"(?:hôm\s+nay|bây\s+giờ|today)"
+_WHICH_DAY = r"(?:ngày\s+mấy|thứ\s+mấy|ngày\s+bao\s+nhiêu|ngày\s+nào|thứ\s+nào)"
+_DATE_QUESTION = (
+    rf"(?<!\w){_TODAY}(?:\s+là)?\s+{_WHICH_DAY}(?!\w)"
+    rf"|(?<!\w){_WHICH_DAY}(?:\s+là)?\s+{_TODAY}(?!\w)"
+)
+
+# Câu hỏi giờ phải có dạng hỏi giờ ("bây giờ là mấy giờ", "what time is it"); các cụm như
+# "thời gian hiện tại", "current time" chỉ tính khi là cả tin nhắn, vì chúng xuất hiện cả trong
+# câu hỏi tài liệu ("Thời gian hiện tại áp dụng cho chu kỳ hiệu chuẩn là bao lâu?")
+_END = r"[\s?.!]*\Z"
+_TIME_QUESTION = (
+    r"(?<!\w)(?:bây\s+giờ|hiện\s+(?:tại|giờ)|giờ\s+hiện\s+tại)(?:\s+là)?\s+mấy\s+giờ(?!\w)"
+    r"|(?<!\w)mấy\s+giờ\s+rồi(?!\w)"
+    r"|(?<!\w)what\s+time\s+is\s+it(?!\w)"
+    rf"|(?<!\w)what(?:'s|\s+is)\s+the\s+(?:current\s+)?time(?:\s+now)?{_END}"
+    rf"|\A\s*(?:giờ\s+hiện\s+tại|thời\s+gian\s+hiện\s+tại|current\s+time|time\s+now){_END}"
+)
+
+# Chỉ khi cả câu hỏi là hỏi địa chỉ ETV, với ETV là chủ ngữ ("ETV ở đâu?", "Địa chỉ của ETV là gì?",
+# "Where is ETV?"); không khớp "Phòng thí nghiệm của ETV ở đâu?" hay "Địa chỉ ETV trên hóa đơn..."
+_ASK = r"\A\s*(?:(?:cho\s+(?:mình|tôi|em)\s+hỏi|xin\s+hỏi|vậy)\s*,?\s*)?"
+_ETV = r"(?:viện\s+)?etv"
+_ETV_CONTACT = (
+    rf"{_ASK}(?:trụ\s+sở\s+(?:của\s+)?)?{_ETV}\s+(?:nằm\s+|(?:có|đặt)\s+trụ\s+sở\s+)?ở\s+đâu(?:\s+vậy)?{_END}"
+    rf"|{_ASK}(?:địa\s+chỉ|trụ\s+sở)\s+(?:của\s+)?{_ETV}(?:\s+(?:là\s+gì|ở\s+đâu|nằm\s+ở\s+đâu))?{_END}"
+    rf"|\A\s*where\s+is\s+(?:the\s+)?{_ETV}(?:\s+located)?{_END}"
+    rf"|\A\s*(?:what\s+is\s+)?(?:the\s+)?(?:{_ETV}(?:'s)?\s+address|address\s+of\s+{_ETV}){_END}"
+)
+
+
+def build_default_router() -> IntentRouter:
+    router = IntentRouter()
+    router.register(
+        "date",
+        _date_answer,
+        phrases=[
+            "hôm nay là ngày", "hôm nay là thứ", "hôm nay ngày", "hôm nay thứ",
+            "what day is it", "what day is today", "what date is it", "what date is today",
+            "what is the date today", "what's the date today", "today's date",
+        ],
+        regex=_DATE_QUESTION,
+    )
+    router.register("time", _time_answer, regex=_TIME_QUESTION)
+    router.register("etv_contact", _etv_contact_answer, regex=_ETV_CONTACT)
+    # Chỉ khi cả tin nhắn là một lời chào
+    router.register(
+        "greeting",
+        _greeting_answer,
+        regex=r"\A\s*(?:xin\s+chào|chào|hello|hi|hey|alo)(?:\s+(?:bạn|bot|chatbot|ad|admin))?[\s!.?👋]*\Z",
+    )
+    return router
+
+
+# Kiểm tra nhanh bộ định tuyến mặc định: python intents.py
+_EXAMPLES = {
+    "Hôm nay là thứ mấy?": ["date"],
+    "hôm nay ngày bao nhiêu": ["date"],
+    "Ngày mấy hôm nay vậy?": ["date"],
+    "What day is it today?": ["date"],
+    "Bây giờ là mấy giờ?": ["time"],
+    "Hôm nay là ngày mấy, bây giờ mấy giờ?": ["date", "time"],
+    "ETV ở đâu?": ["etv_contact"],
+    "Địa chỉ của ETV là gì?": ["etv_contact"],
+    "Trụ sở ETV nằm ở đâu": ["etv_contact"],
+    "Where is ETV located?": ["etv_contact"],
+    "Mấy giờ rồi?": ["time"],
+    "Thời gian hiện tại": ["time"],
+    "What's the time?": ["time"],
+    "Cho mình hỏi ETV ở đâu": ["etv_contact"],
+    "Xin chào!": ["greeting"],
+    # Câu hỏi về tài liệu: phải đi tiếp đến LLM
+    "Hạn nộp hồ sơ là ngày bao nhiêu?": [],
+    "Hợp đồng được ký ngày mấy?": [],
+    "Lịch kiểm định vào thứ mấy?": [],
+    "What date was the contract signed?": [],
+    "Trong tài liệu ETV, quy trình hiệu chuẩn nằm ở mục nào?": [],
+    "Where is the ETV calibration report stored?": [],
+    "Do you know the calibration procedure?": [],
+    "Chào bạn, cho mình hỏi quy trình hiệu chuẩn": [],
+    "Thời gian hiện tại áp dụng cho chu kỳ hiệu chuẩn là bao lâu?": [],
+    "Is the current time synchronization procedure documented?": [],
+    "Phòng thí nghiệm mở cửa lúc mấy giờ?": [],
+    "Phòng thí nghiệm của ETV ở đâu?": [],
+    "Địa chỉ ETV trên hóa đơn ghi thế nào?": [],
+}
+
+
+if __name__ == "__main__":
+    router = build_default_router()
+    failures = [
+        (message, expected, router.match(message))
+        for message, expected in _EXAMPLES.items()
+        if router.match(message) != expected
+    ]
+    for message, expected, got in failures:
+        print(f"FAIL {message!r}: expected {expected}, got {got}")
+    print(f"{len(_EXAMPLES) - len(failures)}/{len(_EXAMPLES)} examples passed")
+    raise SystemExit(1 if failures else 0)
@@ -1,20 +1,20 @@
-from fastapi import FastAPI, UploadFile, File
-from pydantic import BaseModel
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, Request, HTTPException
+from pydantic import BaseModel, field_validator
 from elasticsearch import Elasticsearch
 from langchain.chains import RetrievalQA
 from langchain.vectorstores import ElasticsearchStore
 from langchain.chat_models import ChatOpenAI
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import (
-    TextLoader,
-    PyPDFLoader,
-    UnstructuredMarkdownLoader
-)
-from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
 from dotenv import load_dotenv
-from datetime import datetime
-import pytz
+from chunking import TokenChunker
+from retrieval import RerankRetriever
+from retrieval_cache import RetrievalCache
+from intents import build_default_router
+from filters import build_filters, ensure_metadata_mapping, new_upload_metadata, parse_upload_time, stamp
+from profiler import annotate, llm_trace_handler, recent_traces, stage, trace_request
+from ingest import SUPPORTED_EXTENSIONS, collect_members, ingest_batch, load_file
+from admission import PRIORITY_CACHED, PRIORITY_DEFAULT, AdmissionController, AdmissionRejected, client_key
 import os
 import tempfile
 
@@ -28,6 +28,9 @@ os.environ["OPENAI_API_KEY"] = api_key
 # Kết nối Elasticsearch
 es = Elasticsearch("http://elasticsearch:9200")  # trong docker-compose nên dùng tên service
 
+# Metadata (source, batch_id, uploaded_at...) map kiểu keyword/date để lọc trong knn
+ensure_metadata_mapping(es, "chatbot")
+
 # LLM
 llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.7, max_tokens=100)
 
@@ -35,12 +38,7 @@ llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.7, max_tokens=100)
 embeddings = OpenAIEmbeddings()
 
 # Text splitter
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=200,
-    length_function=len,
-    separators=["\n\n", "\n", " ", ""]
-)
+text_splitter = TokenChunker()
 
 # Vectorstore
 vectorstore = ElasticsearchStore(
@@ -50,59 +48,89 @@ vectorstore = ElasticsearchStore(
     vector_query_field="embedding"
 )
 
-retriever = vectorstore.as_retriever()
+# Cache embedding câu hỏi + kết quả truy xuất, vô hiệu hoá mỗi khi upload xong
+retrieval_cache = RetrievalCache(es, "chatbot")
+retriever = RerankRetriever(es=es, embeddings=embeddings, index_name="chatbot", cache=retrieval_cache)
 qa_chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
 
+# Giới hạn số request gọi LLM đồng thời + rate limit theo client
+admission = AdmissionController()
+
+# Intent tất định dùng chung (ngày/giờ, địa chỉ ETV, lời chào)
+intent_router = build_default_router()
+
 # FastAPI app
 app = FastAPI()
 
+# Đo từng giai đoạn của các endpoint nặng; chỉ ghi trace khi chậm hoặc được lấy mẫu
+PROFILED_PATHS = {"/chatManLab", "/upload", "/upload/batch"}
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    if request.url.path not in PROFILED_PATHS:
+        return await call_next(request)
+    with trace_request(request.url.path):
+        return await call_next(request)
+
 class ChatRequest(BaseModel):
     message: str
+    # Lọc trước khi tìm kNN: theo tên file, lô upload hoặc khoảng thời gian upload (ISO 8601)
+    source: Optional[str] = None
+    batch_id: Optional[str] = None
+    uploaded_from: Optional[str] = None
+    uploaded_to: Optional[str] = None
+
+    @field_validator("uploaded_from", "uploaded_to")
+    @classmethod
+    def _check_upload_time(cls, value: Optional[str]) -> Optional[str]:
+        # Thời gian sai định dạng bị trả về 422 trước khi vào hàng đợi, không đến Elasticsearch
+        return parse_upload_time(value)
 
 @app.get("/")
 def home():
     return {"status": "Chatbot API is running"}
 
+@app.get("/metrics")
+def metrics():
+    return {"admission": admission.metrics(), "intents": intent_router.stats()}
+
+@app.get("/debug/traces")
+def debug_traces(limit: int = 20):
+    return {"traces": recent_traces(limit)}
+
 @app.post("/chatManLab")
-def chat(req: ChatRequest):
-    prompt = req.message.lower()
-
-    # Kiểm tra câu hỏi về thời gian/ngày
-    time_related_keywords = {
-        "date": ["what day", "what date", "today", "ngày", "thứ", "date"],
-        "time": ["what time", "now", "giờ", "thời gian", "time"]
-    }
-
-    is_date_question = any(k in prompt for k in time_related_keywords["date"])
-    is_time_question = any(k in prompt for k in time_related_keywords["time"])
-
-    if is_date_question or is_time_question:
-        vietnam_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-        current_time = datetime.now(vietnam_tz)
-
-        if is_date_question:
-            weekday_names = {
-                0: "Thứ Hai",
-                1: "Thứ Ba",
-                2: "Thứ Tư",
-                3: "Thứ Năm",
-                4: "Thứ Sáu",
-                5: "Thứ Bảy",
-                6: "Chủ Nhật"
-            }
-            month_names = {
-                1: "tháng 1", 2: "tháng 2", 3: "tháng 3", 4: "tháng 4",
-                5: "tháng 5", 6: "tháng 6", 7: "tháng 7", 8: "tháng 8",
-                9: "tháng 9", 10: "tháng 10", 11: "tháng 11", 12: "tháng 12"
-            }
-            response = f"Hôm nay là {weekday_names[current_time.weekday()]}, {current_time.day} {month_names[current_time.month]} năm {current_time.year}"
-        else:
-            response = f"Bây giờ là {current_time.hour:02d}:{current_time.minute:02d}"
+def chat(req: ChatRequest, request: Request):
+    # Intent tất định (ngày/giờ, địa chỉ ETV, lời chào): trả lời ngay, không gọi LLM/ES
+    with stage("intent") as record:
+        response = intent_router.route(req.message or "")
+        record["hit"] = response is not None
+    if response is not None:
+        admission.record_fast_path()
     else:
+        # Có filter: dùng retriever lọc trước trong knn
+        filters = build_filters(req.source, req.batch_id, req.uploaded_from, req.uploaded_to)
+        request_retriever = retriever.with_filters(filters)
+        # Câu hỏi đã có kết quả truy xuất trong cache được ưu tiên trong hàng đợi
+        priority = PRIORITY_CACHED if request_retriever.has_cached_hits(req.message) else PRIORITY_DEFAULT
+        try:
+            with stage("admission", priority=priority):
+                started = admission.acquire(client_key(request), priority)
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Server đang quá tải ({e.reason}), vui lòng thử lại sau",
+                headers={"Retry-After": str(e.retry_after)},
+            )
         try:
-            response = qa_chain.run(req.message)
+            chain = qa_chain
+            if request_retriever is not retriever:
+                # Chain dựng lại cho retriever có filter rất rẻ
+                chain = RetrievalQA.from_chain_type(llm=llm, retriever=request_retriever)
+            response = chain.run(req.message, callbacks=[llm_trace_handler])
         except Exception as e:
             response = f"Lỗi khi tìm kiếm thông tin: {str(e)}"
+        finally:
+            admission.release(started)
 
     return {"answer": response}
 
@@ -110,27 +138,41 @@ def chat(req: ChatRequest):
 async def upload_file(file: UploadFile = File(...)):
     try:
         suffix = os.path.splitext(file.filename)[1]
+        # Kiểm tra đuôi file trước; lỗi của chính loader (file hỏng...) đi theo nhánh lỗi chung
+        if suffix.lower() not in SUPPORTED_EXTENSIONS:
+            return {"error": "Unsupported file type"}
         with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
             tmp_file.write(await file.read())
             tmp_path = tmp_file.name
 
-        if file.filename.endswith(".txt"):
-            loader = TextLoader(tmp_path)
-        elif file.filename.endswith(".pdf"):
-            loader = PyPDFLoader(tmp_path)
-        elif file.filename.endswith(".docx"):
-            loader = UnstructuredFileLoader(tmp_path)
-        elif file.filename.endswith(".md"):
-            loader = UnstructuredMarkdownLoader(tmp_path)
-        else:
-            return {"error": "Unsupported file type"}
-
-        documents = loader.load()
-        splits = text_splitter.split_documents(documents)
-        vectorstore.add_documents(splits)
+        annotate(filename=file.filename)
+        with stage("parse", cpu=True) as record:
+            documents = load_file(tmp_path, file.filename)
+            record["documents"] = len(documents)
+        with stage("split", cpu=True) as record:
+            splits = text_splitter.split_documents(documents, source=file.filename)
+            record["chunks"] = len(splits)
+        upload_metadata = new_upload_metadata()
+        with stage("embed_index", chunks=len(splits)):
+            vectorstore.add_documents(stamp(splits, upload_metadata))
+        retrieval_cache.bump_generation()
 
         os.unlink(tmp_path)
-        return {"status": f"Uploaded and indexed {file.filename}"}
+        return {"status": f"Uploaded and indexed {file.filename}", "batch_id": upload_metadata["batch_id"]}
 
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+@app.post("/upload/batch")
+def upload_batch(files: List[UploadFile] = File(...)):
+    # Nhiều file hoặc archive zip/tar: parse song song, chunk của mọi file dùng chung
+    # các batch embedding + bulk index; trả về một báo cáo cho mỗi file
+    upload_metadata = new_upload_metadata()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with stage("extract", uploads=len(files)):
+            members, skipped = collect_members([(f.filename, f.file) for f in files], tmpdir)
+        reports = ingest_batch(members, vectorstore, upload_metadata)
+
+    if any(report["status"] == "indexed" for report in reports):
+        retrieval_cache.bump_generation()
+    return {"batch_id": upload_metadata["batch_id"], "files": reports + skipped}
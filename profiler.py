@@ -0,0 +1,234 @@
+# profiler.py
+# Hook profiling cho request chậm: mỗi request được đo theo từng giai đoạn
+# (intent, embedding, Elasticsearch, rerank, LLM, parse/split...). Trace chỉ được ghi lại
+# khi request vượt ngưỡng độ trễ hoặc được chọn theo tỉ lệ lấy mẫu; các giai đoạn tốn CPU
+# kèm stack profile lấy mẫu. Trace ghi vào log xoay vòng và xem được qua endpoint debug.
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Any, Dict, Iterator, List, Optional
+
+import tiktoken
+from langchain_core.callbacks import BaseCallbackHandler
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "1") == "1"
+SLOW_THRESHOLD_MS = float(os.getenv("PROFILE_SLOW_MS", "3000"))
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+TRACE_LOG = os.getenv("PROFILE_LOG", "logs/traces.jsonl")
+# Khoảng thời gian lấy mẫu stack (giây) trong các giai đoạn tốn CPU
+STACK_INTERVAL = float(os.getenv("PROFILE_STACK_INTERVAL", "0.005"))
+
+_RECENT_TRACES = 200
+_TOP_STACKS = 15
+_STACK_DEPTH = 25
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("profiler_trace", default=None)
+_recent: deque = deque(maxlen=_RECENT_TRACES)
+_logger: Optional[logging.Logger] = None
+_logger_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, endpoint: str, sampled: bool):
+        self.id = uuid.uuid4().hex[:12]
+        self.endpoint = endpoint
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.stages: List[Dict[str, Any]] = []
+        self.attrs: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.stages.append(record)
+
+    def to_dict(self, total_ms: float) -> dict:
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "started_at": self.started_at,
+            "total_ms": round(total_ms, 1),
+            "sampled": self.sampled,
+            "slow": total_ms >= SLOW_THRESHOLD_MS,
+            **self.attrs,
+            "stages": self.stages,
+        }
+
+
+# -------------------- API dùng trong code --------------------
+@contextmanager
+def trace_request(endpoint: str) -> Iterator[Optional[Trace]]:
+    if not PROFILE_ENABLED:
+        yield None
+        return
+    trace = Trace(endpoint, sampled=random.random() < SAMPLE_RATE)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        total_ms = (time.perf_counter() - trace.started) * 1000
+        if trace.sampled or total_ms >= SLOW_THRESHOLD_MS:
+            _emit(trace.to_dict(total_ms))
+
+
+@contextmanager
+def stage(name: str, cpu: bool = False, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """Đo một giai đoạn; dict được yield để gắn thêm thuộc tính (ví dụ took_ms của ES)."""
+    record: Dict[str, Any] = {"stage": name, **attrs}
+    trace = _current.get()
+    if trace is None:
+        yield record
+        return
+    sampler = _StackSampler(threading.get_ident()) if cpu else None
+    if sampler:
+        sampler.start()
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["ms"] = round((time.perf_counter() - started) * 1000, 2)
+        if sampler:
+            record["stacks"] = sampler.stop()
+        trace.add_stage(record)
+
+
+def annotate(**attrs: Any) -> None:
+    """Gắn thuộc tính cấp request (ví dụ tên file, số chunk) vào trace hiện tại."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def recent_traces(limit: int = 20) -> List[dict]:
+    return list(_recent)[-limit:][::-1]
+
+
+# -------------------- LLM callback --------------------
+class LLMTraceHandler(BaseCallbackHandler):
+    """Ghi số token của prompt, thời gian tới token đầu tiên và tổng thời gian gọi LLM."""
+
+    def __init__(self):
+        self._runs: Dict[Any, Dict[str, Any]] = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._start(run_id, "\n".join(prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        text = "\n".join(str(m.content) for batch in messages for m in batch)
+        self._start(run_id, text)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs) -> None:
+        record = self._runs.get(run_id)
+        if record is not None and "ttft_ms" not in record:
+            record["ttft_ms"] = round((time.perf_counter() - record["_started"]) * 1000, 2)
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        self._finish(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._finish(run_id, error=str(error))
+
+    def _start(self, run_id, prompt: str) -> None:
+        if _current.get() is None:
+            return
+        self._runs[run_id] = {
+            "stage": "llm",
+            "prompt_tokens": _count_tokens(prompt),
+            "_started": time.perf_counter(),
+        }
+
+    def _finish(self, run_id, **attrs: Any) -> None:
+        record = self._runs.pop(run_id, None)
+        trace = _current.get()
+        if record is None or trace is None:
+            return
+        record["ms"] = round((time.perf_counter() - record.pop("_started")) * 1000, 2)
+        # Không stream thì token đầu tiên đến cùng lúc với toàn bộ câu trả lời
+        record.setdefault("ttft_ms", None)
+        record.update(attrs)
+        trace.add_stage(record)
+
+
+llm_trace_handler = LLMTraceHandler()
+
+
+# -------------------- Nội bộ --------------------
+class _StackSampler:
+    """Lấy mẫu stack của một thread theo chu kỳ, gộp thành dạng collapsed (a;b;c -> số mẫu)."""
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> List[dict]:
+        self._stop.set()
+        self._thread.join()
+        return [{"stack": stack, "samples": n} for stack, n in self.samples.most_common(_TOP_STACKS)]
+
+    def _run(self) -> None:
+        while not self._stop.wait(STACK_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < _STACK_DEPTH:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.samples[";".join(reversed(names))] += 1
+
+
+_encoding = None
+
+
+def _count_tokens(text: str) -> Optional[int]:
+    global _encoding
+    try:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return None
+
+
+def _emit(record: dict) -> None:
+    _recent.append(record)
+    logger = _get_logger()
+    if logger is not None:
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def _get_logger() -> Optional[logging.Logger]:
+    global _logger
+    if _logger is not None:
+        return _logger
+    with _logger_lock:
+        if _logger is None:
+            try:
+                os.makedirs(os.path.dirname(TRACE_LOG) or ".", exist_ok=True)
+                handler = RotatingFileHandler(TRACE_LOG, maxBytes=5_000_000, backupCount=5, encoding="utf-8")
+            except OSError:
+                return None
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("chatbot.traces")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
@@ -0,0 +1,240 @@
+# retrieval.py
+# Bước hậu truy xuất dùng chung: lấy rộng tập ứng viên (rẻ), chọn đa dạng bằng MMR
+# trên embedding của ứng viên và xếp hạng lại bằng điểm từ vựng cục bộ,
+# chỉ gửi vài đoạn tốt nhất cho LLM.
+import math
+import os
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from profiler import stage
+
+# Số ứng viên lấy từ Elasticsearch và số đoạn thực sự gửi cho LLM
+FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))
+TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+# 1.0 = chỉ xét độ liên quan, 0.0 = chỉ xét độ đa dạng
+MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.6"))
+# Trọng số của điểm từ vựng khi trộn với độ tương đồng vector
+LEXICAL_WEIGHT = float(os.getenv("RETRIEVAL_LEXICAL_WEIGHT", "0.3"))
+# Ứng viên có độ liên quan dưới tỉ lệ này so với ứng viên tốt nhất bị loại,
+# nên có thể trả về ít hơn k đoạn
+RELEVANCE_FLOOR = float(os.getenv("RETRIEVAL_RELEVANCE_FLOOR", "0.3"))
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_COMBINING_RE = re.compile(r"[\u0300-\u036f]")
+_HASH_DIM = 1024
+_DUPLICATE_SIM = 0.97
+
+
+def tokenize(text: str) -> List[str]:
+    # Bỏ dấu giống content.folded bên Elasticsearch: "thach ban" khớp "Thạch Bàn"
+    folded = _COMBINING_RE.sub("", unicodedata.normalize("NFD", text.lower())).replace("đ", "d")
+    return _TOKEN_RE.findall(folded)
+
+
+def lexical_scores(query: str, texts: Sequence[str], k1: float = 1.2, b: float = 0.75) -> np.ndarray:
+    """BM25 tính trên chính tập ứng viên, chuẩn hoá về [0, 1]."""
+    query_terms = set(tokenize(query))
+    docs = [Counter(tokenize(t)) for t in texts]
+    if not query_terms or not docs:
+        return np.zeros(len(texts), dtype=np.float32)
+
+    lengths = np.array([sum(d.values()) for d in docs], dtype=np.float32)
+    avg_len = float(lengths.mean()) or 1.0
+    n = len(docs)
+    scores = np.zeros(n, dtype=np.float32)
+    for term in query_terms:
+        tf = np.array([d.get(term, 0) for d in docs], dtype=np.float32)
+        df = int((tf > 0).sum())
+        if df == 0:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        scores += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths / avg_len))
+
+    top = scores.max()
+    return scores / top if top > 0 else scores
+
+
+def hashed_vectors(texts: Sequence[str], dim: int = _HASH_DIM) -> np.ndarray:
+    """Vector bag-of-words băm, dùng cho MMR khi ứng viên không có embedding."""
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for term, count in Counter(tokenize(text)).items():
+            matrix[row, zlib.crc32(term.encode("utf-8")) % dim] += count
+    return matrix
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def mmr_select(
+    relevance: np.ndarray,
+    vectors: np.ndarray,
+    k: int,
+    lambda_mult: float = MMR_LAMBDA,
+    min_relevance: float = RELEVANCE_FLOOR,
+) -> List[int]:
+    """Maximal Marginal Relevance, vector hoá: ma trận tương đồng tính một lần."""
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    k = min(k, n)
+    top = float(relevance.max())
+    # Không lấp đủ k chỗ bằng các đoạn không liên quan chỉ vì chúng "đa dạng";
+    # không ứng viên nào có điểm thì chỉ giữ ứng viên đầu tiên
+    irrelevant = relevance < min_relevance * top if top > 0 else np.ones(n, dtype=bool)
+    unit = _normalize(np.asarray(vectors, dtype=np.float32))
+    pairwise = unit @ unit.T
+
+    selected = [int(np.argmax(relevance))]
+    # Độ tương đồng lớn nhất của mỗi ứng viên với các đoạn đã chọn
+    max_sim = pairwise[selected[0]].copy()
+    chosen = np.zeros(n, dtype=bool)
+    chosen[selected[0]] = True
+    while len(selected) < k:
+        mmr = lambda_mult * relevance - (1 - lambda_mult) * max_sim
+        # Các chunk gần như trùng lặp (overlap, trang lặp lại) không bao giờ được chọn lần hai
+        mmr[chosen | irrelevant | (max_sim >= _DUPLICATE_SIM)] = -np.inf
+        best = int(np.argmax(mmr))
+        if mmr[best] == -np.inf:
+            break
+        selected.append(best)
+        chosen[best] = True
+        np.maximum(max_sim, pairwise[best], out=max_sim)
+    return selected
+
+
+def rerank(
+    query: str,
+    texts: Sequence[str],
+    vectors: Optional[np.ndarray] = None,
+    query_vector: Optional[Sequence[float]] = None,
+    k: int = TOP_K,
+    search_scores: Optional[Sequence[float]] = None,
+) -> List[int]:
+    """Trả về chỉ số của k ứng viên tốt nhất theo thứ tự gửi cho LLM.
+
+    search_scores: _score của Elasticsearch cho đường từ vựng, trộn với BM25 cục bộ.
+    """
+    if not texts:
+        return []
+    lexical = lexical_scores(query, texts)
+    if vectors is not None and query_vector is not None and len(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dense = _normalize(vectors) @ _normalize(np.asarray(query_vector, dtype=np.float32))
+        relevance = (1 - LEXICAL_WEIGHT) * dense + LEXICAL_WEIGHT * lexical
+    else:
+        vectors = hashed_vectors(texts)
+        relevance = lexical
+        if search_scores is not None:
+            search = np.asarray(search_scores, dtype=np.float32)
+            top = search.max()
+            search = search / top if top > 0 else search
+            relevance = (1 - LEXICAL_WEIGHT) * search + LEXICAL_WEIGHT * lexical
+    return mmr_select(relevance, vectors, k)
+
+
+def select_passages(
+    query: str,
+    texts: Sequence[str],
+    k: int = TOP_K,
+    scores: Optional[Sequence[float]] = None,
+) -> List[str]:
+    """Dùng cho đường tìm kiếm từ vựng (không có embedding); scores là _score của các hit."""
+    return [texts[i] for i in rerank(query, texts, k=k, search_scores=scores)]
+
+
+class RerankRetriever(BaseRetriever):
+    """Retriever kNN trên Elasticsearch + MMR/rerank cục bộ, thay cho vectorstore.as_retriever()."""
+
+    es: Any
+    embeddings: Any
+    index_name: str = "chatbot"
+    vector_field: str = "embedding"
+    text_field: str = "text"
+    fetch_k: int = FETCH_K
+    k: int = TOP_K
+    cache: Optional[Any] = None
+    # Mệnh đề filter ES (xem filters.build_filters), áp dụng bên trong knn
+    filters: Optional[List[dict]] = None
+
+    def with_filters(self, filters: Optional[List[dict]]) -> "RerankRetriever":
+        """Bản sao của retriever chỉ tìm trong các chunk khớp filters."""
+        if not filters:
+            return self
+        return self.model_copy(update={"filters": filters})
+
+    def _search(self, query_vector: List[float]) -> List[dict]:
+        knn = {
+            "field": self.vector_field,
+            "query_vector": query_vector,
+            "k": self.fetch_k,
+            "num_candidates": max(self.fetch_k * 5, 50),
+        }
+        if self.filters:
+            knn["filter"] = self.filters
+        with stage("es_search", k=self.fetch_k, filtered=bool(self.filters)) as record:
+            res = self.es.search(
+                index=self.index_name,
+                knn=knn,
+                source=[self.text_field, "metadata", self.vector_field],
+                size=self.fetch_k,
+            )
+            record["took_ms"] = res.get("took")
+            record["hits"] = len(res["hits"]["hits"])
+        return res["hits"]["hits"]
+
+    def _embed_query(self, query: str) -> List[float]:
+        if self.cache is not None:
+            return self.cache.embed_query(self.embeddings, query)
+        return self.embeddings.embed_query(query)
+
+    def has_cached_embedding(self, query: str) -> bool:
+        """True nếu câu hỏi đã có embedding trong cache (không gọi API embedding)."""
+        return self.cache is not None and self.cache.has_embedding(query)
+
+    def has_cached_hits(self, query: str) -> bool:
+        """True nếu kết quả truy xuất của câu hỏi (với filters hiện tại) còn trong cache."""
+        if not self.has_cached_embedding(query):
+            return False
+        query_vector = self.cache.embed_query(self.embeddings, query)
+        key = self.cache.hits_key(query_vector, self.fetch_k, self.k, filters=self.filters)
+        return self.cache.get_hits(key) is not None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with stage("embedding", cached=self.has_cached_embedding(query)):
+            query_vector = self._embed_query(query)
+        if self.cache is not None:
+            generation = self.cache.generation.current()
+            key = self.cache.hits_key(query_vector, self.fetch_k, self.k, filters=self.filters)
+            with stage("retrieval_cache") as record:
+                cached = self.cache.get_hits(key)
+                record["hit"] = cached is not None
+            if cached is not None:
+                return [Document(page_content=text, metadata=dict(metadata)) for text, metadata in cached]
+
+        hits = self._search(query_vector)
+        texts = [hit["_source"].get(self.text_field, "") for hit in hits]
+        order = []
+        if hits:
+            with stage("rerank", candidates=len(hits)):
+                vectors = np.array([hit["_source"][self.vector_field] for hit in hits], dtype=np.float32)
+                order = rerank(query, texts, vectors, query_vector, k=self.k)
+        selected = [(texts[i], hits[i]["_source"].get("metadata") or {}) for i in order]
+
+        if self.cache is not None:
+            self.cache.put_hits(key, selected, generation)
+        return [Document(page_content=text, metadata=dict(metadata)) for text, metadata in selected]
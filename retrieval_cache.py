@@ -0,0 +1,157 @@
+# retrieval_cache.py
+# Cache cho bước truy xuất: LRU câu hỏi -> embedding (bỏ qua API embedding khi hỏi lại)
+# và (hash embedding, k, filters) -> danh sách kết quả (bỏ qua Elasticsearch).
+# Kết quả được gắn với "index generation": mỗi lần upload xong, generation tăng lên
+# nên không bao giờ trả về kết quả cũ hơn lần upload gần nhất.
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+# Thời gian (giây) tin vào generation đã đọc trước khi hỏi lại Elasticsearch,
+# để thấy được upload từ tiến trình khác (FastAPI <-> Streamlit)
+INDEX_GENERATION_TTL = float(os.getenv("INDEX_GENERATION_TTL", "1.0"))
+META_INDEX = "chatbot_meta"
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class IndexGeneration:
+    """Bộ đếm generation của index, chia sẻ giữa các tiến trình qua một document trong Elasticsearch."""
+
+    def __init__(self, es=None, index_name: str = "chatbot", ttl: float = INDEX_GENERATION_TTL):
+        self.es = es
+        self.index_name = index_name
+        self.ttl = ttl
+        self._value = 0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> int:
+        if self.es is None or time.monotonic() - self._checked_at < self.ttl:
+            return self._value
+        try:
+            res = self.es.get(index=META_INDEX, id=self.index_name)
+            remote = int(res["_source"]["generation"])
+        except Exception:
+            # Chưa có document meta hoặc ES lỗi: dùng giá trị cục bộ
+            remote = self._value
+        with self._lock:
+            self._value = max(self._value, remote)
+            self._checked_at = time.monotonic()
+            return self._value
+
+    def bump(self) -> int:
+        with self._lock:
+            self._value += 1
+            local = self._value
+        if self.es is not None:
+            try:
+                res = self.es.update(
+                    index=META_INDEX,
+                    id=self.index_name,
+                    script={"source": "ctx._source.generation += 1"},
+                    upsert={"generation": local},
+                    refresh=True,
+                    source=True,
+                )
+                local = int(res["get"]["_source"]["generation"])
+            except Exception:
+                pass
+        with self._lock:
+            self._value = max(self._value, local)
+            self._checked_at = time.monotonic()
+            return self._value
+
+
+class RetrievalCache:
+    def __init__(
+        self,
+        es=None,
+        index_name: str = "chatbot",
+        embedding_size: int = EMBEDDING_CACHE_SIZE,
+        hits_size: int = RETRIEVAL_CACHE_SIZE,
+    ):
+        self.generation = IndexGeneration(es, index_name)
+        self.embeddings = LRUCache(embedding_size)
+        self.hits = LRUCache(hits_size)
+
+    # -------------------- Embedding --------------------
+    def embed_query(self, embeddings, query: str) -> List[float]:
+        # Embedding của câu hỏi không phụ thuộc nội dung index nên không cần gắn generation
+        key = _normalize_query(query)
+        vector = self.embeddings.get(key)
+        if vector is None:
+            vector = embeddings.embed_query(query)
+            self.embeddings.put(key, vector)
+        return vector
+
+    def has_embedding(self, query: str) -> bool:
+        return _normalize_query(query) in self.embeddings
+
+    # -------------------- Kết quả truy xuất --------------------
+    def hits_key(self, query: Any, *params: Any, filters: Any = None) -> tuple:
+        if isinstance(query, str):
+            digest = hashlib.sha1(_normalize_query(query).encode("utf-8")).hexdigest()
+        else:
+            digest = hashlib.sha1(np.asarray(query, dtype=np.float32).tobytes()).hexdigest()
+        return (digest, params, json.dumps(filters or {}, sort_keys=True, default=str))
+
+    def get_hits(self, key: tuple) -> Optional[Sequence]:
+        entry = self.hits.get(key)
+        if entry is None:
+            return None
+        generation, value = entry
+        return value if generation == self.generation.current() else None
+
+    def put_hits(self, key: tuple, value: Sequence, generation: int) -> None:
+        # generation phải được đọc TRƯỚC khi truy vấn ES, để kết quả lấy trong lúc
+        # đang có upload không bị gắn nhầm generation mới
+        if generation == self.generation.current():
+            self.hits.put(key, (generation, value))
+
+    def bump_generation(self) -> int:
+        generation = self.generation.bump()
+        self.hits.clear()
+        return generation
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.split())
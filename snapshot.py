@@ -0,0 +1,182 @@
+# snapshot.py
+# Xuất / nhập index "chatbot" (text, metadata, vector) ra một file nhị phân gọn,
+# để dựng môi trường mới mà không phải upload lại tài liệu hay gọi API embedding.
+#
+#   python snapshot.py export chatbot.snap
+#   python snapshot.py import chatbot.snap [--index chatbot] [--replace]
+#
+# Định dạng file:
+#   MAGIC | u32 độ dài header | header JSON (index, mapping, analysis, dims)
+#   rồi lần lượt các block: u32 số doc | u32 độ dài payload | u32 độ dài vector
+#                           | payload zlib(JSON các _source không có vector)
+#                           | vector float32 little-endian (chỉ các doc có vector)
+#   block có số doc = 0 đánh dấu kết thúc file.
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from typing import BinaryIO, Iterator, List, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from elasticsearch import Elasticsearch, helpers
+
+from retrieval_cache import IndexGeneration
+
+MAGIC = b"ETVSNAP1"
+BLOCK_DOCS = 1000
+_U32 = struct.Struct("<I")
+_BLOCK = struct.Struct("<III")
+
+
+# -------------------- Export --------------------
+def export_index(es: Elasticsearch, index: str, path: str, vector_field: str = "embedding") -> int:
+    mapping = es.indices.get_mapping(index=index)[index]["mappings"]
+    settings = es.indices.get_settings(index=index)[index]["settings"]["index"]
+    dims = mapping.get("properties", {}).get(vector_field, {}).get("dims")
+    header = {
+        "index": index,
+        "vector_field": vector_field,
+        "dims": dims,
+        "mappings": mapping,
+        "analysis": settings.get("analysis"),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+    total = 0
+    with open(path, "wb") as f:
+        _write_header(f, json.dumps(header, ensure_ascii=False).encode("utf-8"))
+        batch: List[dict] = []
+        for hit in helpers.scan(es, index=index, query={"query": {"match_all": {}}}, size=BLOCK_DOCS):
+            batch.append(hit)
+            if len(batch) >= BLOCK_DOCS:
+                total += _write_block(f, batch, vector_field, dims)
+                batch = []
+        if batch:
+            total += _write_block(f, batch, vector_field, dims)
+        f.write(_BLOCK.pack(0, 0, 0))
+    return total
+
+
+def _write_header(f: BinaryIO, header: bytes) -> None:
+    f.write(MAGIC)
+    f.write(_U32.pack(len(header)))
+    f.write(header)
+
+
+def _write_block(f: BinaryIO, hits: List[dict], vector_field: str, dims) -> int:
+    docs = []
+    vectors = []
+    for hit in hits:
+        source = dict(hit["_source"])
+        vector = source.pop(vector_field, None)
+        if vector is not None and (dims is None or len(vector) == dims):
+            vectors.append(vector)
+            has_vector = True
+        else:
+            has_vector = False
+        docs.append({"_id": hit["_id"], "v": has_vector, "s": source})
+
+    payload = zlib.compress(json.dumps(docs, ensure_ascii=False).encode("utf-8"), 6)
+    raw = np.asarray(vectors, dtype="<f4").tobytes() if vectors else b""
+    f.write(_BLOCK.pack(len(docs), len(payload), len(raw)))
+    f.write(payload)
+    f.write(raw)
+    return len(docs)
+
+
+# -------------------- Import --------------------
+def read_snapshot(path: str) -> Tuple[dict, Iterator[dict]]:
+    f = open(path, "rb")
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError(f"{path} không phải file snapshot hợp lệ")
+    (header_len,) = _U32.unpack(f.read(_U32.size))
+    header = json.loads(f.read(header_len))
+    return header, _iter_docs(f, header)
+
+
+def _iter_docs(f: BinaryIO, header: dict) -> Iterator[dict]:
+    vector_field = header["vector_field"]
+    with f:
+        while True:
+            n_docs, payload_len, raw_len = _BLOCK.unpack(f.read(_BLOCK.size))
+            if n_docs == 0:
+                return
+            docs = json.loads(zlib.decompress(f.read(payload_len)))
+            vectors = np.frombuffer(f.read(raw_len), dtype="<f4")
+            n_vectors = sum(1 for d in docs if d["v"])
+            if n_vectors:
+                vectors = vectors.reshape(n_vectors, -1)
+            row = 0
+            for doc in docs:
+                source = doc["s"]
+                if doc["v"]:
+                    source[vector_field] = vectors[row].tolist()
+                    row += 1
+                yield {"_id": doc["_id"], "_source": source}
+
+
+def import_snapshot(es: Elasticsearch, path: str, index: str = None, replace: bool = False) -> int:
+    header, docs = read_snapshot(path)
+    index = index or header["index"]
+
+    if replace and es.indices.exists(index=index):
+        es.indices.delete(index=index)
+    if not es.indices.exists(index=index):
+        body = {"mappings": header["mappings"]}
+        if header.get("analysis"):
+            body["settings"] = {"analysis": header["analysis"]}
+        es.indices.create(index=index, body=body)
+
+    # Tắt refresh/replica trong lúc nạp hàng loạt, khôi phục giá trị cũ khi xong
+    current = es.indices.get_settings(index=index)[index]["settings"]["index"]
+    restore = {
+        "refresh_interval": current.get("refresh_interval"),
+        "number_of_replicas": current.get("number_of_replicas"),
+    }
+    es.indices.put_settings(index=index, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    total = 0
+    try:
+        actions = ({"_index": index, "_id": d["_id"], "_source": d["_source"]} for d in docs)
+        for ok, item in helpers.parallel_bulk(es, actions, chunk_size=500, thread_count=4, raise_on_error=False):
+            if ok:
+                total += 1
+            else:
+                print(f"Lỗi khi nạp document: {item}", file=sys.stderr)
+    finally:
+        es.indices.put_settings(index=index, settings={"index": restore})
+        es.indices.refresh(index=index)
+
+    # Index đã thay đổi: các cache truy xuất đang chạy phải bỏ kết quả cũ
+    IndexGeneration(es, index).bump()
+    return total
+
+
+def main(argv=None) -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Xuất / nhập snapshot index Elasticsearch của chatbot")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="Đường dẫn file snapshot")
+    parser.add_argument("--index", default=None, help="Tên index (mặc định: chatbot, hoặc tên lưu trong snapshot khi import)")
+    parser.add_argument("--vector-field", default="embedding")
+    parser.add_argument("--replace", action="store_true", help="Xoá index hiện có trước khi import")
+    parser.add_argument("--es", default=os.getenv("ELASTICSEARCH_URL", "http://localhost:9200"))
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(args.es, request_timeout=120)
+    started = time.monotonic()
+    if args.command == "export":
+        n = export_index(es, args.index or "chatbot", args.path, args.vector_field)
+        size_mb = os.path.getsize(args.path) / 1e6
+        print(f"Đã xuất {n} document vào {args.path} ({size_mb:.1f} MB) trong {time.monotonic() - started:.1f}s")
+    else:
+        n = import_snapshot(es, args.path, args.index, args.replace)
+        print(f"Đã nạp {n} document từ {args.path} trong {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
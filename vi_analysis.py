@@ -0,0 +1,81 @@
+# vi_analysis.py
+# Phân tích tiếng Việt cho truy vấn từ vựng trên trường `content`: ngoài trường gốc
+# (giữ dấu), thêm subfield bỏ dấu (asciifolding, "thach ban" khớp "Thạch Bàn") và
+# subfield ghép cặp âm tiết liền kề (shingle 2 âm tiết, gần với từ ghép tiếng Việt).
+# Truy vấn multi_match cộng điểm của cả ba trường nên chỉ cần lấy ít ứng viên hơn.
+import logging
+import os
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# Số ứng viên lấy từ Elasticsearch trước khi chọn đoạn gửi cho LLM
+LEXICAL_FETCH_K = int(os.getenv("LEXICAL_FETCH_K", "8"))
+
+CONTENT_ANALYSIS = {
+    "filter": {
+        "vi_bigram": {
+            "type": "shingle",
+            "min_shingle_size": 2,
+            "max_shingle_size": 2,
+            "output_unigrams": False,
+        },
+    },
+    "analyzer": {
+        "vi_original": {"tokenizer": "standard", "filter": ["lowercase"]},
+        "vi_folded": {"tokenizer": "standard", "filter": ["lowercase", "asciifolding"]},
+        "vi_bigram": {"tokenizer": "standard", "filter": ["lowercase", "asciifolding", "vi_bigram"]},
+    },
+}
+
+CONTENT_MAPPING = {
+    "properties": {
+        "content": {
+            "type": "text",
+            "analyzer": "vi_original",
+            "fields": {
+                "folded": {"type": "text", "analyzer": "vi_folded"},
+                "bigrams": {"type": "text", "analyzer": "vi_bigram"},
+            },
+        }
+    }
+}
+
+# Khớp đúng dấu và khớp cả cụm hai âm tiết được ưu tiên hơn khớp bỏ dấu từng âm tiết
+_FIELD_BOOSTS = {"": 2.0, ".folded": 1.0, ".bigrams": 1.5}
+
+
+def normalize_text(text: str) -> str:
+    # Dấu tiếng Việt có thể ở dạng tổ hợp (NFD) hoặc dựng sẵn (NFC); đưa về NFC trước khi
+    # index và truy vấn để cùng một âm tiết luôn ra cùng một token
+    return unicodedata.normalize("NFC", text)
+
+
+def create_content_index(es, index_name: str) -> None:
+    """Tạo index với analyzer tiếng Việt; cảnh báo nếu index đã có nhưng tạo trước khi có analyzer."""
+    if not es.indices.exists(index=index_name):
+        es.indices.create(
+            index=index_name,
+            body={"settings": {"analysis": CONTENT_ANALYSIS}, "mappings": CONTENT_MAPPING},
+        )
+        return
+
+    # Không thể thêm analyzer vào index đang mở: index cũ cần được tạo lại
+    mapping = es.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    fields = mapping.get("properties", {}).get("content", {}).get("fields", {})
+    if "folded" not in fields or "bigrams" not in fields:
+        logger.warning(
+            "Index %s chưa có analyzer tiếng Việt cho content, cần tạo lại index và upload lại tài liệu",
+            index_name,
+        )
+
+
+def content_query(text: str, field: str = "content") -> dict:
+    """Truy vấn multi_match (most_fields) trên trường gốc, trường bỏ dấu và trường cặp âm tiết."""
+    return {
+        "multi_match": {
+            "query": normalize_text(text),
+            "type": "most_fields",
+            "fields": [f"{field}{suffix}^{boost}" for suffix, boost in _FIELD_BOOSTS.items()],
+        }
+    }